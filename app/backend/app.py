@@ -20,7 +20,7 @@ from azure.storage.blob import (
     ResourceTypes,
     generate_account_sas,
 )
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from shared_code.status_log import State, StatusClassification, StatusLog
 from shared_code.tags_helper import TagsHelper
 
@@ -74,6 +74,7 @@ QUERY_TERM_LANGUAGE = os.environ.get("QUERY_TERM_LANGUAGE") or "English"
 
 TARGET_EMBEDDING_MODEL = os.environ.get("TARGET_EMBEDDINGS_MODEL") or "BAAI/bge-small-en-v1.5"
 ENRICHMENT_APPSERVICE_NAME = os.environ.get("ENRICHMENT_APPSERVICE_NAME") or "enrichment"
+OAI_MAX_CONCURRENCY = int(os.environ.get("OAI_MAX_CONCURRENCY") or 16)
 
 # embedding_service_suffix = "xyoek"
 
@@ -175,7 +176,8 @@ chat_approaches = {
         model_version,
         IS_GOV_CLOUD_DEPLOYMENT,
         TARGET_EMBEDDING_MODEL,
-        ENRICHMENT_APPSERVICE_NAME
+        ENRICHMENT_APPSERVICE_NAME,
+        OAI_MAX_CONCURRENCY
     )
 }
 
@@ -196,6 +198,13 @@ def chat():
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
+        if request.json.get("stream"):
+            # Newline delimited JSON: {"delta": ...} lines as the answer is generated, then the full response.
+            # Deltas are the raw model text for progressive display only; the final response's "answer" is
+            # URL-decoded and authoritative, so clients should replace the streamed text with it.
+            return Response(
+                stream_with_context(stream_chat(impl, request.json["history"], request.json.get("overrides") or {})),
+                mimetype="application/x-ndjson")
         r = impl.run(request.json["history"], request.json.get("overrides") or {})
 
         # return jsonify(r)
@@ -213,6 +222,16 @@ def chat():
         logging.exception("Exception in /chat")
         return jsonify({"error": str(ex)}), 500
 
+def stream_chat(impl, history, overrides):
+    """Serialise each item yielded by the approach as a line of JSON"""
+    try:
+        for item in impl.run_stream(history, overrides):
+            yield json.dumps(item) + "\n"
+    except Exception as ex:
+        # The response headers have already been sent, so report the failure in the stream
+        logging.exception("Exception in /chat stream")
+        yield json.dumps({"error": str(ex)}) + "\n"
+
 @app.route("/getblobclienturl")
 def get_blob_client_url():
     """Get a URL for a file in Blob Storage with SAS token"""
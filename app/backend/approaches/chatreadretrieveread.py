@@ -1,12 +1,17 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import functools
 import json
 import re
 import logging
+import random
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Sequence
+from typing import Any, Iterator, Sequence
 
 import openai
 from approaches.approach import Approach
@@ -26,12 +31,32 @@ from azure.storage.blob import (
 )
 from text import nonewlines
 import tiktoken
+from core.completioncache import CompletionCache
 from core.messagebuilder import MessageBuilder
 from core.modelhelper import get_token_limit
 from core.modelhelper import num_tokens_from_messages
 import requests
 from urllib.parse import quote
 
+# Characters that are not allowed in the embedding model name segment of the enrichment URL
+MODEL_NAME_ESCAPE_PATTERN = re.compile(r'[^a-zA-Z0-9_\-.]')
+
+# OpenAI failures worth retrying with backoff, and how many attempts to make in total
+RETRYABLE_OPENAI_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+)
+OPENAI_MAX_ATTEMPTS = 6
+OPENAI_MAX_BACKOFF_SECONDS = 30
+
+# Worker threads for background calls to the enrichment embedding service
+EMBEDDING_MAX_WORKERS = 4
+
+# How long the answer step waits for the question embedding used by the semantic cache lookup
+QUESTION_EMBEDDING_TIMEOUT_SECONDS = 2
+
 # Simple retrieve-then-read implementation, using the Cognitive Search and
 # OpenAI APIs directly. It first retrieves top documents from search,
 # then constructs a prompt with them, and then uses OpenAI to generate
@@ -111,7 +136,8 @@ class ChatReadRetrieveReadApproach(Approach):
         model_version: str,
         is_gov_cloud_deployment: str,
         TARGET_EMBEDDING_MODEL: str,
-        ENRICHMENT_APPSERVICE_NAME: str
+        ENRICHMENT_APPSERVICE_NAME: str,
+        oai_max_concurrency: int = 16
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -124,12 +150,15 @@ class ChatReadRetrieveReadApproach(Approach):
         self.query_term_language = query_term_language
         self.chatgpt_token_limit = get_token_limit(model_name)
         #escape target embeddiong model name
-        self.escaped_target_model = re.sub(r'[^a-zA-Z0-9_\-.]', '_', TARGET_EMBEDDING_MODEL)
+        self.escaped_target_model = MODEL_NAME_ESCAPE_PATTERN.sub('_', TARGET_EMBEDDING_MODEL)
         
         if is_gov_cloud_deployment:
             self.embedding_service_url = f'https://{ENRICHMENT_APPSERVICE_NAME}.azurewebsites.us'
         else:
             self.embedding_service_url = f'https://{ENRICHMENT_APPSERVICE_NAME}.azurewebsites.net'
+        self.embedding_url = f'{self.embedding_service_url}/models/{self.escaped_target_model}/embed'
+        # requests sessions are not thread safe, so each Flask worker thread lazily gets its own
+        self._embedding_sessions = threading.local()
 
         if is_gov_cloud_deployment:
             openai.api_base = 'https://' + oai_service_name + '.openai.azure.us/'
@@ -142,19 +171,40 @@ class ChatReadRetrieveReadApproach(Approach):
         self.model_name = model_name
         self.model_version = model_version
         self.is_gov_cloud_deployment = is_gov_cloud_deployment
+
+        # Final answers keyed by prompt, with a semantic fallback on the embedding of the user's question
+        self.completion_cache = CompletionCache(max_entries=512, similarity_threshold=0.95)
+        # Generated search queries, exact match only
+        self.query_cache = CompletionCache(max_entries=512, similarity_threshold=None)
+        # Worker pool for embedding calls that run alongside the rest of the request
+        self.embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS, thread_name_prefix="embedding")
+        # Caps the OpenAI requests in flight from this process so bursts queue here instead of being throttled
+        self.completion_semaphore = threading.BoundedSemaphore(oai_max_concurrency)
         
 
     # def run(self, history: list[dict], overrides: dict) -> any:
     def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        response = None
+        for response in self.run_stream(history, overrides):
+            pass
+        return response
+
+    def run_stream(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        """
+        Run the approach, yielding {"delta": text} for each part of the answer as it is generated
+        and finally the full response with data points, thoughts and citations.
+        Deltas are the raw model text; the final "answer" is URL-decoded and is the one to keep.
+        """
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         user_persona = overrides.get("user_persona", "")
         system_persona = overrides.get("system_persona", "")
-        response_length = int(overrides.get("response_length") or 1024)
+        response_length = overrides.get("response_length")
+        response_length = int(response_length) if response_length else 1024
         folder_filter = overrides.get("selected_folders", "")
         tags_filter = overrides.get("selected_tags", "")
 
-        user_q = 'Generate search query for: ' + history[-1]["user"]
+        user_q = f'Generate search query for: {history[-1]["user"]}'
         
         query_prompt=self.query_prompt_template.format(query_term_language=self.query_term_language)
         
@@ -169,35 +219,28 @@ class ChatReadRetrieveReadApproach(Approach):
             self.chatgpt_token_limit - len(user_q)
             )
 
-        chat_completion = openai.ChatCompletion.create(
-            deployment_id=self.chatgpt_deployment,
-            model=self.model_name,
-            messages=messages,
-            temperature=0.0,
-            # max_tokens=32, # setting it too low may cause malformed JSON
-            max_tokens=100,
-            n=1)
-
-        generated_query = chat_completion.choices[0].message.content
+        # The answer cache matches on the user's question, so embed it in the background while
+        # the search query is generated, embedded and searched
+        question_embedding = self.embedding_executor.submit(self.get_embedding, history[-1]["user"])
+
+        # Query generation runs at temperature 0, so a conversation seen before reuses its search query
+        query_cache_key = CompletionCache.make_key(messages)
+        generated_query = self.query_cache.get(query_cache_key)
+        if generated_query is None:
+            chat_completion = self.create_chat_completion(
+                messages=messages,
+                temperature=0.0,
+                # max_tokens=32, # setting it too low may cause malformed JSON
+                max_tokens=100,
+                n=1)
+            generated_query = chat_completion.choices[0].message.content
+            self.query_cache.put(query_cache_key, generated_query)
         #if we fail to generate a query, return the last user question
         if generated_query.strip() == "0":
             generated_query = history[-1]["user"]
 
         # Generate embedding using REST API
-        url = f'{self.embedding_service_url}/models/{self.escaped_target_model}/embed'
-        data = [f'"{generated_query}"']
-        headers = {
-                'Accept': 'application/json',  
-                'Content-Type': 'application/json',
-            }
-
-        response = requests.post(url, json=data,headers=headers,timeout=60)
-        if response.status_code == 200:
-            response_data = response.json()
-            embedded_query_vector =response_data.get('data')          
-        else:
-            logging.error(f"Error generating embedding:: {response.status_code}")
-            raise Exception('Error generating embedding:', response.status_code)
+        embedded_query_vector = self.get_embedding(generated_query)
 
         #vector set up for pure vector search & Hybrid search & Hybrid semantic
         vector = RawVectorQuery(vector=embedded_query_vector, k=top, fields="contentVector")
@@ -263,21 +306,21 @@ class ChatReadRetrieveReadApproach(Approach):
 
         for idx, doc in enumerate(r):  # for each document in the search results
             # include the "FileX" moniker in the prompt, and the actual file name in the response
-            results.append(
-                f"File{idx} " + "| " + nonewlines(doc[self.content_field])
-            )
+            # flatten the chunk once and reuse it for both the prompt and the response
+            doc_content = nonewlines(doc[self.content_field])
+            source_file = doc[self.source_file_field]
+            results.append(f"File{idx} | {doc_content}")
             data_points.append(
-               "/".join(urllib.parse.unquote(doc[self.source_file_field]).split("/")[4:]
-                ) + "| " + nonewlines(doc[self.content_field])
-                )
+                f"{'/'.join(urllib.parse.unquote(source_file).split('/')[4:])}| {doc_content}"
+            )
             # uncomment to debug size of each search result content_field
             # print(f"File{idx}: ", self.num_tokens_from_string(f"File{idx} " + /
             #  "| " + nonewlines(doc[self.content_field]), "cl100k_base"))
 
             # add the "FileX" moniker and full file name to the citation lookup
             citation_lookup[f"File{idx}"] = {
-                "citation": urllib.parse.unquote("https://" + doc[self.source_file_field].split("/")[2] + f"/{self.content_storage_container}/" + doc[self.chunk_file_field]),
-                "source_path": self.get_source_file_with_sas(doc[self.source_file_field]),
+                "citation": urllib.parse.unquote(f"https://{source_file.split('/')[2]}/{self.content_storage_container}/{doc[self.chunk_file_field]}"),
+                "source_path": self.get_source_file_with_sas(source_file),
                 "page_number": str(doc[self.page_number_field][0]) or "0",
              }
             
@@ -287,7 +330,7 @@ class ChatReadRetrieveReadApproach(Approach):
         if results_text == "":
             content = "\n NONE"
         else:
-            content = "\n " + results_text
+            content = f"\n {results_text}"
 
         # STEP 3: Generate the prompt to be sent to the GPT model
         follow_up_questions_prompt = (
@@ -333,13 +376,23 @@ class ChatReadRetrieveReadApproach(Approach):
             )
         # STEP 3: Generate a contextual and content-specific answer using the search results and chat history.
         #Added conditional block to use different system messages for different models.
+        # Near-duplicate questions may only reuse an answer when the prompt context and sources are identical.
+        # They are matched on the user's own wording, as the keyword search query drops the question's intent.
+        cache_partition = [system_message, content, history[:-1]]
+        # The embedding only feeds the semantic cache lookup, so a failure or slow response
+        # falls back to exact matching instead of failing the request
+        try:
+            question_vector = question_embedding.result(timeout=QUESTION_EMBEDDING_TIMEOUT_SECONDS)
+        except Exception as error:
+            logging.warning(f"Question embedding unavailable, answer cache limited to exact matches: {error!r}")
+            question_vector = None
 
         if self.model_name.startswith("gpt-35-turbo"):
             messages = self.get_messages_from_history(
                 system_message,
                 self.model_name,
                 history,
-                history[-1]["user"] + "Sources:\n" + content + "\n\n", # 3.5 has recency Bias that is why this is here
+                f"{history[-1]['user']}Sources:\n{content}\n\n", # 3.5 has recency Bias that is why this is here
                 self.response_prompt_few_shots,
                 max_tokens=self.chatgpt_token_limit - 500
             )
@@ -355,13 +408,9 @@ class ChatReadRetrieveReadApproach(Approach):
             #print("Few Shot Tokens: ", self.num_tokens_from_string(self.response_prompt_few_shots[0]['content'], "cl100k_base"))
             #print("Message Tokens: ", self.num_tokens_from_string(message_string, "cl100k_base"))
 
-            chat_completion = openai.ChatCompletion.create(
-            deployment_id=self.chatgpt_deployment,
-            model=self.model_name,
-            messages=messages,
-            temperature=float(overrides.get("response_temp")) or 0.6,
-            n=1
-        )
+            completion_args = {
+                "temperature": float(overrides.get("response_temp")) or 0.6
+            }
 
         elif self.model_name.startswith("gpt-4"):
             messages = self.get_messages_from_history(
@@ -370,7 +419,7 @@ class ChatReadRetrieveReadApproach(Approach):
                 self.model_name,
                 history,
                 # history[-1]["user"],
-                history[-1]["user"] + "Sources:\n" + content + "\n\n", # GPT 4 starts to degrade with long system messages. so moving sources here 
+                f"{history[-1]['user']}Sources:\n{content}\n\n", # GPT 4 starts to degrade with long system messages. so moving sources here 
                 self.response_prompt_few_shots,
                 max_tokens=self.chatgpt_token_limit
             )
@@ -386,25 +435,120 @@ class ChatReadRetrieveReadApproach(Approach):
             #print("Few Shot Tokens: ", self.num_tokens_from_string(self.response_prompt_few_shots[0]['content'], "cl100k_base"))
             #print("Message Tokens: ", self.num_tokens_from_string(message_string, "cl100k_base"))
 
-            chat_completion = openai.ChatCompletion.create(
-            deployment_id=self.chatgpt_deployment,
-            model=self.model_name,
-            messages=messages,
-            temperature=float(overrides.get("response_temp")) or 0.6,
-            max_tokens=1024,
-            n=1
-        )
+            completion_args = {
+                "temperature": float(overrides.get("response_temp")) or 0.6,
+                "max_tokens": 1024
+            }
+
+        answer_parts = []
+        for delta in self._stream_completion(messages, cache_partition, question_vector, **completion_args):
+            answer_parts.append(delta)
+            yield {"delta": delta}
+        answer = "".join(answer_parts)
 
         # STEP 4: Format the response
-        msg_to_display = '\n\n'.join([str(message) for message in messages])
+        # replace newlines per message so the joined prompt is only scanned once
+        msg_to_display = '<br><br>'.join(str(message).replace('\n', '<br>') for message in messages)
 
-        return {
+        yield {
             "data_points": data_points,
-            "answer": f"{urllib.parse.unquote(chat_completion.choices[0].message.content)}",
-            "thoughts": f"Searched for:<br>{generated_query}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>'),
+            "answer": urllib.parse.unquote(answer),
+            "thoughts": f"Searched for:<br>{generated_query}<br><br>Conversations:<br>{msg_to_display}",
             "citation_lookup": citation_lookup
         }
 
+    def get_embedding(self, text: str) -> list[float]:
+        """ Function to return the embedding of the text from the enrichment embedding service"""
+        data = [f'"{text}"']
+        response = self.get_embedding_session().post(self.embedding_url, json=data, timeout=60)
+        if response.status_code == 200:
+            response_data = response.json()
+            return response_data.get('data')
+        logging.error(f"Error generating embedding:: {response.status_code}")
+        raise Exception('Error generating embedding:', response.status_code)
+
+    def get_embedding_session(self) -> requests.Session:
+        """ Function to return this thread's keep-alive session for the embedding service"""
+        session = getattr(self._embedding_sessions, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+            })
+            self._embedding_sessions.session = session
+        return session
+
+    def create_chat_completion(self, **completion_args) -> Any:
+        """
+        Call ChatCompletion.create for the configured deployment within the concurrency limit,
+        retrying throttled and transient failures with jittered exponential backoff.
+        A streamed response is only read once this returns, so with stream=True the permit is
+        still held on return and the caller must release completion_semaphore once the stream
+        has been read or closed.
+        """
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            self.completion_semaphore.acquire()
+            try:
+                response = openai.ChatCompletion.create(
+                    deployment_id=self.chatgpt_deployment,
+                    model=self.model_name,
+                    **completion_args
+                )
+            except BaseException as error:
+                # back off without holding a permit
+                self.completion_semaphore.release()
+                if not isinstance(error, RETRYABLE_OPENAI_ERRORS) or attempt == OPENAI_MAX_ATTEMPTS - 1:
+                    raise
+                delay = min(2 ** attempt + random.random(), OPENAI_MAX_BACKOFF_SECONDS)
+                logging.warning(f"OpenAI request failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if not completion_args.get("stream"):
+                self.completion_semaphore.release()
+            return response
+
+    def _stream_completion(
+        self,
+        messages: list[dict[str, str]],
+        partition: Any,
+        question_vector: list[float],
+        **completion_args) -> Iterator[str]:
+        """
+        Yield the completion for the messages as it is generated. An exact or near-duplicate
+        request that has already been answered is served whole from the completion cache.
+        """
+        key = CompletionCache.make_key(messages, completion_args)
+        partition_key = CompletionCache.make_key(partition, completion_args)
+        cached = self.completion_cache.get(key, partition_key, question_vector)
+        if cached is not None:
+            yield cached
+            return
+
+        chat_completion = self.create_chat_completion(
+            messages=messages,
+            n=1,
+            stream=True,
+            **completion_args
+        )
+        content_parts = []
+        try:
+            for chunk in chat_completion:
+                # Azure OpenAI sends a leading chunk with only content filter results and no choices
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    content_parts.append(delta)
+                    yield delta
+        finally:
+            # the request is in flight until its stream is fully read or the caller stops reading
+            self.completion_semaphore.release()
+        content = "".join(content_parts)
+        # Never cache an empty answer, e.g. a stream stopped by the content filter
+        if content:
+            self.completion_cache.put(key, content, partition_key, question_vector)
+
     #Aparmar. Custom method to construct Chat History as opposed to single string of chat History.
     def get_messages_from_history(
         self,
@@ -412,7 +556,7 @@ class ChatReadRetrieveReadApproach(Approach):
         model_id: str,
         history: Sequence[dict[str, str]],
         user_conv: str,
-        few_shots = [],
+        few_shots: Sequence[dict[str, str]] = (),
         max_tokens: int = 4096) -> []:
         """
         Construct a list of messages from the chat history and the user's question.
@@ -420,8 +564,15 @@ class ChatReadRetrieveReadApproach(Approach):
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Few Shot prompting. Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in few_shots:
-            message_builder.append_message(shot.get('role'), shot.get('content'))
+        shot_pairs, shot_token_length = self._cached_few_shots(
+            model_id,
+            tuple((shot.get('role'), shot.get('content')) for shot in few_shots)
+        )
+        # fresh dicts per call so no request can alter the cached shots
+        message_builder.insert_counted_messages(
+            [{'role': role, 'content': content} for role, content in shot_pairs],
+            shot_token_length
+        )
 
         user_content = user_conv
         append_index = len(few_shots) + 1
@@ -438,8 +589,24 @@ class ChatReadRetrieveReadApproach(Approach):
         messages = message_builder.messages
         return messages
 
+    @staticmethod
+    @functools.lru_cache(maxsize=4)
+    def _cached_few_shots(model_id: str, few_shots: tuple[tuple[str, str], ...]) -> tuple[tuple[tuple[str, str], ...], int]:
+        """
+        Return the few shot (role, content) pairs and their token length, counted once per model and set of shots.
+        The shots are in the order append_message(index=1) has always produced, i.e. reversed.
+        """
+        shot_pairs = tuple(reversed(few_shots))
+        token_length = sum(
+            num_tokens_from_messages({'role': role, 'content': content}, model_id)
+            for role, content in shot_pairs
+        )
+        return shot_pairs, token_length
+
     #Get the prompt text for the response length
-    def get_response_length_prompt_text(self, response_length: int):
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def get_response_length_prompt_text(response_length: int):
         """ Function to return the response length prompt text"""
         levels = {
             1024: "succinct",
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+
+class CompletionCache:
+    """
+      An in-process LRU cache of chat completions with an optional semantic fallback lookup.
+      Attributes:
+          max_entries (int): The maximum number of completions kept before the least recently used is evicted.
+          similarity_threshold (float): The minimum cosine similarity for a semantic hit. None for an exact-match only cache.
+      Methods:
+          make_key(*parts): Builds a stable hash from any JSON serialisable values.
+          get(self, key: str, partition: str = None, vector: list[float] = None): Returns a cached completion or None.
+          put(self, key: str, content: str, partition: str = None, vector: list[float] = None): Stores a completion.
+      """
+
+    def __init__(self, max_entries: int = 512, similarity_threshold: Optional[float] = None):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        # key -> (partition, L2-normalised vector, content)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """ Function to return a stable hash of the given values"""
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str, partition: Optional[str] = None, vector: Optional[list[float]] = None) -> Optional[Any]:
+        """ Function to return the cached completion for an exact or near-duplicate request.
+        A semantic hit needs a similarity threshold and a vector, and is only considered within
+        the same partition, so the prompt context (system message, sources, history) must match
+        and only the question wording may differ."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[2]
+
+            if self.similarity_threshold is None or vector is None:
+                return None
+            candidates = [(k, e) for k, e in self._entries.items()
+                          if e[0] == partition and e[1] is not None]
+            if not candidates:
+                return None
+            unit_vector = self._normalize(vector)
+            matrix = np.stack([e[1] for _, e in candidates])
+            scores = np.dot(matrix, unit_vector)
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+            best_key, best_entry = candidates[best]
+            self._entries.move_to_end(best_key)
+            return best_entry[2]
+
+    def put(self, key: str, content: Any, partition: Optional[str] = None, vector: Optional[list[float]] = None):
+        """ Function to store a completion, evicting the least recently used entry when full"""
+        unit_vector = (self._normalize(vector)
+                       if self.similarity_threshold is not None and vector is not None else None)
+        with self._lock:
+            self._entries[key] = (partition, unit_vector, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _normalize(vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
@@ -11,6 +11,7 @@ class MessageBuilder:
       Methods:
           __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
           append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+          insert_counted_messages(self, messages: list, token_length: int, index: int = 1): Inserts messages whose tokens are already counted.
       """
 
     def __init__(self, system_content: str, chatgpt_model: str):
@@ -22,4 +23,8 @@ class MessageBuilder:
     def append_message(self, role: str, content: str, index: int = 1):
         self.messages.insert(index, {'role': role, 'content': content})
         self.token_length += num_tokens_from_messages(
-            self.messages[index], self.model)
\ No newline at end of file
+            self.messages[index], self.model)
+
+    def insert_counted_messages(self, messages: list[dict[str, str]], token_length: int, index: int = 1):
+        self.messages[index:index] = messages
+        self.token_length += token_length
@@ -1,3 +1,5 @@
+import functools
+
 import tiktoken
 
 #Values from https://platform.openai.com/docs/models/gpt-3-5
@@ -17,6 +19,7 @@ AOAI_2_OAI = {
 }
 
 
+@functools.lru_cache(maxsize=32)
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
         raise ValueError("Expected model gpt-35-turbo and above. Got: " + model_id)